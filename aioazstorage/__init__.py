@@ -1,3 +1,29 @@
-from .tables import TableClient
-from .queues import QueueClient
-from .blobs import BlobClient
\ No newline at end of file
+from importlib import import_module as _import_module
+from sys import version_info as _version_info
+
+# service modules (and aiohttp) are only imported when first used, to keep cold starts cheap
+_exports = {
+    'TableClient': '.tables',
+    'TableWriteBuffer': '.tables',
+    'QueueClient': '.queues',
+    'BlobClient': '.blobs',
+    'BlobManifest': '.manifest'
+}
+
+__all__ = list(_exports)
+
+if _version_info >= (3, 7):
+    def __getattr__(name):
+        if name in _exports:
+            value = getattr(_import_module(_exports[name], __name__), name)
+            globals()[name] = value
+            return value
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    def __dir__():
+        return sorted(set(globals()) | set(__all__))
+else: # module __getattr__ requires Python 3.7
+    from .tables import TableClient, TableWriteBuffer
+    from .queues import QueueClient
+    from .blobs import BlobClient
+    from .manifest import BlobManifest
@@ -1,22 +1,30 @@
 from aiohttp import ClientSession, ClientResponse
-from asyncio import sleep
+from asyncio import sleep, ensure_future, Queue, CancelledError
 from base64 import b64encode, b64decode
 from datetime import datetime
 from email.utils import formatdate, parsedate_to_datetime
 from hashlib import sha256, md5
 from hmac import HMAC
-from xml.etree import cElementTree
-from typing import Generator
-from logging import getLogger, basicConfig
-from os import environ
+from itertools import islice
+try:
+    from xml.etree import cElementTree
+except ImportError: # removed in Python 3.9
+    from xml.etree import ElementTree as cElementTree
+from typing import Generator, Iterable
+from urllib.parse import quote, urlencode
+from uuid import uuid1
+from re import compile as re_compile
+from time import monotonic
+from logging import getLogger
 try:
     from ujson import dumps
 except ImportError:
     from json import dumps
 
 log = getLogger(__name__)
-basicConfig(format = 'time=%(asctime)s loc=%(funcName)s:%(lineno)d msg="%(message)s"',
-            level  = environ.get('LOGLEVEL','DEBUG'))
+
+BATCH_SIZE = 256 # maximum number of sub-requests in a Blob Batch request
+_batch_status = re_compile(r'Content-ID: (\d+)\s+HTTP/1\.1 (\d+)')
 
 class BlobClient:
     account = None
@@ -55,17 +63,22 @@ class BlobClient:
     def _sign_for_blobs(self, verb: str, canonicalized: str, headers={}, payload='') -> dict:
         """Compute SharedKeyLite authorization header and add standard headers"""
         headers = self._headers(headers)
-        signing_headers = sorted(filter(lambda x: 'x-ms' in x, headers.keys()))
-        canon_headers = "\n".join("{}:{}".format(k, headers[k]) for k in signing_headers)
-        sign = "\n".join([verb, '', headers['Content-Type'], '', canon_headers, canonicalized]).encode('utf-8')
         return {
-            'Authorization': 'SharedKeyLite {}:{}'.format(self.account, \
-                b64encode(HMAC(self.auth, sign, sha256).digest()).decode('utf-8')),
+            'Authorization': self._authorization(verb, canonicalized, headers),
             'Content-Length': str(len(payload)),
             **headers
         }
 
 
+    def _authorization(self, verb: str, canonicalized: str, headers: dict) -> str:
+        """Compute a SharedKeyLite signature over the given headers"""
+        signing_headers = sorted(filter(lambda x: 'x-ms' in x, headers.keys()))
+        canon_headers = "\n".join("{}:{}".format(k, headers[k]) for k in signing_headers)
+        sign = "\n".join([verb, '', headers.get('Content-Type', ''), '', canon_headers, canonicalized]).encode('utf-8')
+        return 'SharedKeyLite {}:{}'.format(self.account, \
+            b64encode(HMAC(self.auth, sign, sha256).digest()).decode('utf-8'))
+
+
     async def createContainer(self, container_name) -> ClientResponse:
         canon = f'/{self.account}/{container_name}'
         uri = f'https://{self.account}.blob.core.windows.net/{container_name}?restype=container'
@@ -112,14 +125,34 @@ class BlobClient:
             log.error(await res.text())
 
 
-    async def listBlobs(self, container_name, marker=None) -> Generator[dict, None, None]:
+    async def listBlobs(self, container_name, marker=None, prefix=None, delimiter=None, maxresults=None, raise_errors=False) -> Generator[dict, None, None]:
+        """Enumerate blobs, optionally under `prefix`. If a `delimiter` is given, virtual directories
+           are returned as `{"name": ..., "blobprefix": True}` entries instead of being descended into.
+           With `raise_errors` set, a failed page raises ClientResponseError instead of ending the listing,
+           so callers can tell a complete listing from a partial one."""
         canon = f'/{self.account}/{container_name}?comp=list'
-        if marker is None:
-            uri = f'https://{self.account}.blob.core.windows.net/{container_name}?restype=container&comp=list&include=metadata'
-        else:
-            uri = f'https://{self.account}.blob.core.windows.net/{container_name}?restype=container&comp=list&include=metadata&marker={marker}'
-        res = await self.session.get(uri, headers=self._sign_for_blobs("GET", canon))
-        if res.ok:
+        query = {
+            'restype': 'container',
+            'comp': 'list',
+            'include': 'metadata'
+        }
+        if prefix:
+            query['prefix'] = prefix
+        if delimiter:
+            query['delimiter'] = delimiter
+        if maxresults:
+            query['maxresults'] = maxresults
+        if marker is not None:
+            query['marker'] = marker
+        while True:
+            uri = f'https://{self.account}.blob.core.windows.net/{container_name}?' + urlencode(query)
+            res = await self.session.get(uri, headers=self._sign_for_blobs("GET", canon))
+            if not res.ok:
+                log.error(res.status)
+                log.error(await res.text())
+                if raise_errors:
+                    res.raise_for_status()
+                return
             doc = cElementTree.fromstring(await res.text())
             for blob in doc.findall(".//Blob"):
                 item = {
@@ -136,16 +169,70 @@ class BlobClient:
                         else:
                             item[prop.tag.lower()] = prop.text
                 yield item
+            for blob_prefix in doc.findall(".//BlobPrefix"):
+                yield {
+                    "name": blob_prefix.find("Name").text,
+                    "blobprefix": True
+                }
             tag = doc.find("NextMarker")
-            if tag is not None:
-                if tag.text:
-                    del res
-                    del doc
-                    async for item in self.listBlobs(container_name, tag.text):
-                        yield item
-        else:
-            log.error(res.status)
-            log.error(await res.text())
+            if tag is None or not tag.text:
+                return
+            query['marker'] = tag.text
+            del res
+            del doc
+
+
+    async def listBlobsSharded(self, container_names, prefixes=None, delimiter='/', depth=1, maxresults=None, concurrency=16) -> Generator[dict, None, None]:
+        """Enumerate one or more containers as a single stream, listing shards concurrently.
+           Each container is split by the given `prefixes` (default: the whole container), and each
+           of those is further split into virtual directories up to `depth` levels down. Blobs that
+           match none of the `prefixes` are not returned. Items carry a `container` key, and
+           ordering across shards is not preserved. A shard that fails to list raises in the consumer."""
+        if isinstance(container_names, str):
+            container_names = [container_names]
+        if prefixes is None:
+            prefixes = ['']
+        work = Queue()
+        results = Queue(maxsize=concurrency * (maxresults or 5000))
+        for container_name in container_names:
+            for prefix in prefixes:
+                work.put_nowait((container_name, prefix, depth))
+
+        async def worker():
+            while True:
+                container_name, prefix, level = await work.get()
+                try:
+                    async for item in self.listBlobs(container_name, prefix=prefix, delimiter=delimiter if level > 0 else None,
+                                                     maxresults=maxresults, raise_errors=True):
+                        if item.get("blobprefix"):
+                            work.put_nowait((container_name, item["name"], level - 1))
+                        else:
+                            item["container"] = container_name
+                            await results.put(item)
+                except CancelledError: # an Exception subclass before Python 3.8
+                    raise
+                except Exception as e:
+                    await results.put(e)
+                finally:
+                    work.task_done()
+
+        async def supervisor():
+            await work.join()
+            await results.put(None)
+
+        tasks = [ensure_future(worker()) for _ in range(concurrency)]
+        tasks.append(ensure_future(supervisor()))
+        try:
+            while True:
+                item = await results.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            for task in tasks:
+                task.cancel()
 
   
     async def putBlob(self, container_name: str, blob_path: str, payload, mimetype="application/octet-stream") -> ClientResponse:
@@ -168,4 +255,157 @@ class BlobClient:
         }
         return await self.session.put(uri, headers=self._sign_for_blobs("PUT", canon, headers))
 
-   # https://docs.microsoft.com/en-us/rest/api/storageservices/list-blobs 
+    async def getBlobProperties(self, container_name: str, blob_path: str) -> ClientResponse:
+        """Retrieve blob properties (including copy status) without fetching its contents"""
+        canon = f'/{self.account}/{container_name}/{blob_path}'
+        uri = f'https://{self.account}.blob.core.windows.net/{container_name}/{blob_path}'
+        return await self.session.head(uri, headers=self._sign_for_blobs("HEAD", canon))
+
+
+    async def deleteBlob(self, container_name: str, blob_path: str, snapshots: str = None) -> ClientResponse:
+        """Delete a blob. `snapshots` can be 'include' or 'only' if the blob has snapshots"""
+        canon = f'/{self.account}/{container_name}/{blob_path}'
+        uri = f'https://{self.account}.blob.core.windows.net/{container_name}/{blob_path}'
+        headers = {}
+        if snapshots:
+            headers['x-ms-delete-snapshots'] = snapshots
+        return await self.session.delete(uri, headers=self._sign_for_blobs("DELETE", canon, headers))
+
+
+    async def copyBlob(self, container_name: str, blob_path: str, source_url: str, wait=False, poll_interval=1.0, timeout=None, abort_on_timeout=False) -> ClientResponse:
+        """Server-side copy from `source_url` (which must be readable by the service, e.g. via a SAS token).
+           If `wait` is set, poll the destination until the copy is no longer pending and return the last
+           properties response, which carries the final `x-ms-copy-status`. If it is still pending after
+           `timeout` seconds, polling stops (aborting the copy if `abort_on_timeout` is set) and the last
+           properties response is returned, with `x-ms-copy-status` still 'pending'."""
+        canon = f'/{self.account}/{container_name}/{blob_path}'
+        uri = f'https://{self.account}.blob.core.windows.net/{container_name}/{blob_path}'
+        headers = {
+            'x-ms-copy-source': source_url
+        }
+        res = await self.session.put(uri, headers=self._sign_for_blobs("PUT", canon, headers))
+        if not wait or not res.ok:
+            return res
+        deadline = None if timeout is None else monotonic() + timeout
+        while res.headers.get('x-ms-copy-status') == 'pending':
+            if deadline is not None and monotonic() >= deadline:
+                log.warning(f'copy to {container_name}/{blob_path} still pending after {timeout}s')
+                if abort_on_timeout:
+                    (await self.abortCopyBlob(container_name, blob_path, res.headers['x-ms-copy-id'])).release()
+                break
+            await sleep(poll_interval)
+            res = await self.getBlobProperties(container_name, blob_path)
+            if not res.ok:
+                break
+        return res
+
+
+    async def abortCopyBlob(self, container_name: str, blob_path: str, copy_id: str) -> ClientResponse:
+        """Abort a pending copy, leaving a zero-length destination blob"""
+        canon = f'/{self.account}/{container_name}/{blob_path}?comp=copy'
+        uri = f'https://{self.account}.blob.core.windows.net/{container_name}/{blob_path}?comp=copy&copyid={copy_id}'
+        headers = {
+            'x-ms-copy-action': 'abort'
+        }
+        return await self.session.put(uri, headers=self._sign_for_blobs("PUT", canon, headers))
+
+
+    async def putBlockFromURL(self, container_name: str, blob_path: str, block_id: str, source_url: str, source_range: tuple = None) -> ClientResponse:
+        """Stage a block server-side from `source_url`, optionally limited to an inclusive (start, end) byte range.
+           Staged blocks become visible once committed with putBlockList."""
+        canon = f'/{self.account}/{container_name}/{blob_path}?comp=block'
+        block_id = quote(b64encode(block_id.encode('utf-8')).decode('utf-8'), safe='')
+        uri = f'https://{self.account}.blob.core.windows.net/{container_name}/{blob_path}?comp=block&blockid={block_id}'
+        headers = {
+            'x-ms-copy-source': source_url
+        }
+        if source_range:
+            headers['x-ms-source-range'] = 'bytes={}-{}'.format(*source_range)
+        return await self.session.put(uri, headers=self._sign_for_blobs("PUT", canon, headers))
+
+
+    async def putBlockList(self, container_name: str, blob_path: str, block_ids: Iterable[str], mimetype="application/octet-stream") -> ClientResponse:
+        """Commit staged blocks (in the given order) as the blob contents"""
+        canon = f'/{self.account}/{container_name}/{blob_path}?comp=blocklist'
+        uri = f'https://{self.account}.blob.core.windows.net/{container_name}/{blob_path}?comp=blocklist'
+        payload = '<?xml version="1.0" encoding="utf-8"?><BlockList>{}</BlockList>'.format(
+            ''.join('<Latest>{}</Latest>'.format(b64encode(block_id.encode('utf-8')).decode('utf-8')) for block_id in block_ids))
+        headers = {
+            'x-ms-blob-content-type': mimetype,
+            'Content-Type': 'application/xml'
+        }
+        return await self.session.put(uri, data=payload, headers=self._sign_for_blobs("PUT", canon, headers, payload))
+
+
+    def _batch_subrequest(self, verb: str, container_name: str, blob_path: str, comp=None, headers={}) -> str:
+        """Build a signed Blob Batch sub-request (these must not carry x-ms-version)"""
+        path = f'/{container_name}/{quote(blob_path)}'
+        canon = f'/{self.account}{path}' # the signature covers the encoded path
+        if comp:
+            canon = canon + f'?comp={comp}'
+            path = path + f'?comp={comp}'
+        headers = {
+            'x-ms-date': formatdate(usegmt=True),
+            **headers
+        }
+        headers['Authorization'] = self._authorization(verb, canon, headers)
+        headers['Content-Length'] = '0'
+        return '\r\n'.join([f'{verb} {path} HTTP/1.1', *("{}: {}".format(k, v) for k, v in headers.items()), ''])
+
+
+    async def _batch(self, container_name: str, blob_paths: Iterable[str], verb: str, comp=None, headers={}) -> Generator[dict, None, None]:
+        """Send sub-requests in chunks of up to BATCH_SIZE, yielding a status per blob"""
+        canon = f'/{self.account}/?comp=batch'
+        uri = f'https://{self.account}.blob.core.windows.net/?comp=batch'
+        blob_paths = iter(blob_paths)
+        while True:
+            chunk = list(islice(blob_paths, BATCH_SIZE)) # only hold one batch worth of names
+            if not chunk:
+                return
+            boundary = 'batch_{}'.format(str(uuid1()))
+            parts = []
+            for content_id, blob_path in enumerate(chunk):
+                parts.extend([
+                    f'--{boundary}',
+                    'Content-Type: application/http',
+                    'Content-Transfer-Encoding: binary',
+                    f'Content-ID: {content_id}',
+                    '',
+                    self._batch_subrequest(verb, container_name, blob_path, comp, headers)
+                ])
+            parts.extend([f'--{boundary}--', ''])
+            payload = '\r\n'.join(parts)
+            batch_headers = {
+                'x-ms-version': '2018-11-09', # Blob Batch requires a newer API version
+                'Content-Type': f'multipart/mixed; boundary={boundary}'
+            }
+            res = await self.session.post(uri, data=payload, headers=self._sign_for_blobs("POST", canon, batch_headers, payload))
+            if res.ok:
+                statuses = {int(i): int(status) for i, status in _batch_status.findall(await res.text())}
+                for content_id, blob_path in enumerate(chunk):
+                    yield {"name": blob_path, "status": statuses.get(content_id)}
+            else:
+                log.error(res.status)
+                log.error(await res.text())
+                for blob_path in chunk:
+                    yield {"name": blob_path, "status": res.status}
+
+
+    async def batchDeleteBlobs(self, container_name: str, blob_paths: Iterable[str], snapshots: str = None) -> Generator[dict, None, None]:
+        """Delete blobs through the Blob Batch API, BATCH_SIZE blobs per request"""
+        headers = {}
+        if snapshots:
+            headers['x-ms-delete-snapshots'] = snapshots
+        async for item in self._batch(container_name, blob_paths, "DELETE", headers=headers):
+            yield item
+
+
+    async def batchSetBlobTier(self, container_name: str, blob_paths: Iterable[str], tier: str) -> Generator[dict, None, None]:
+        """Set the access tier of blobs through the Blob Batch API, BATCH_SIZE blobs per request"""
+        headers = {
+            'x-ms-access-tier': tier
+        }
+        async for item in self._batch(container_name, blob_paths, "PUT", "tier", headers):
+            yield item
+
+   # https://docs.microsoft.com/en-us/rest/api/storageservices/list-blobs
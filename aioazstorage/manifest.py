@@ -0,0 +1,163 @@
+from datetime import datetime, timezone
+from sqlite3 import connect
+from typing import Generator
+from logging import getLogger
+from uuid import uuid4
+
+log = getLogger(__name__)
+
+CHUNK_SIZE = 1000 # rows read or written per statement while refreshing
+
+_schema = """
+CREATE TABLE IF NOT EXISTS blobs (
+    container TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER,
+    md5 BLOB,
+    etag TEXT,
+    last_modified REAL,
+    tier TEXT,
+    PRIMARY KEY (container, name)
+) WITHOUT ROWID
+"""
+
+
+def _prefix_range(prefix: str) -> tuple:
+    """Return the [start, end) name range covering all names under prefix"""
+    if not prefix:
+        return ('', None)
+    return (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+
+class BlobManifest:
+    """Local SQLite index of blob listings, for answering existence, size and MD5
+       lookups and prefix queries without going back to the service"""
+    path = None
+    db = None
+
+    def __init__(self, path=':memory:') -> None:
+        """Open (or create) a manifest at path"""
+
+        self.path = path
+        self.db = connect(path)
+        self.db.execute(_schema)
+
+
+    def close(self) -> None:
+        self.db.close()
+
+
+    def _range_query(self, columns: str, container_name: str, prefix: str) -> tuple:
+        start, end = _prefix_range(prefix)
+        if end is None:
+            return (f'SELECT {columns} FROM blobs WHERE container = ? AND name >= ? ORDER BY name', (container_name, start))
+        return (f'SELECT {columns} FROM blobs WHERE container = ? AND name >= ? AND name < ? ORDER BY name', (container_name, start, end))
+
+
+    def _snapshot(self, table: str) -> Generator[tuple, None, None]:
+        """Yield (name, etag) from a refresh snapshot in name order, CHUNK_SIZE rows at a time"""
+        rows = self.db.execute(f'SELECT name, etag FROM temp.{table} ORDER BY name LIMIT ?', (CHUNK_SIZE,)).fetchall()
+        while rows:
+            yield from rows
+            rows = self.db.execute(f'SELECT name, etag FROM temp.{table} WHERE name > ? ORDER BY name LIMIT ?',
+                                   (rows[-1][0], CHUNK_SIZE)).fetchall()
+
+
+    async def refresh(self, client, container_name: str, prefix: str = '', maxresults=None) -> dict:
+        """Bring the entries under prefix up to date with a listing from client (a BlobClient).
+           The listing is merged in name order against a snapshot of the current entries, so only
+           rows whose Etag changed are rewritten and rows the listing skipped over are removed,
+           CHUNK_SIZE at a time. If the listing fails, what was merged so far is kept, entries past
+           the last listed name are left alone and the error is raised. Returns counts of added,
+           updated, deleted and unchanged entries."""
+        counts = {"added": 0, "updated": 0, "deleted": 0, "unchanged": 0}
+        # snapshot the names under prefix, so that rows we write are not mistaken for known ones
+        snapshot = 'refresh_' + uuid4().hex
+        self.db.execute(f'CREATE TEMP TABLE {snapshot} (name TEXT PRIMARY KEY, etag TEXT) WITHOUT ROWID')
+        with self.db:
+            query, params = self._range_query('name, etag', container_name, prefix)
+            self.db.execute(f'INSERT INTO temp.{snapshot} {query}', params)
+        known = self._snapshot(snapshot)
+        current = next(known, None)
+        rows = []
+        deleted = []
+
+        def write():
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                self.db.executemany('DELETE FROM blobs WHERE container = ? AND name = ?', ((container_name, name) for name in deleted))
+            counts["deleted"] += len(deleted)
+            rows.clear()
+            deleted.clear()
+
+        try:
+            async for blob in client.listBlobs(container_name, prefix=prefix, maxresults=maxresults, raise_errors=True):
+                name = blob["name"]
+                # listings are in name order, so known names before this one were deleted
+                while current is not None and current[0] < name:
+                    deleted.append(current[0])
+                    current = next(known, None)
+                if current is not None and current[0] == name:
+                    etag = current[1]
+                    current = next(known, None)
+                    if etag == blob.get("etag"):
+                        counts["unchanged"] += 1
+                        continue
+                    counts["updated"] += 1
+                else:
+                    counts["added"] += 1
+                last_modified = blob.get("last-modified")
+                rows.append((container_name, name, blob.get("content-length"), blob.get("content-md5"), blob.get("etag"),
+                             last_modified.timestamp() if last_modified else None, blob.get("accesstier")))
+                if len(rows) + len(deleted) >= CHUNK_SIZE:
+                    write()
+            # only a complete listing can tell us that the remaining names were deleted
+            while current is not None:
+                deleted.append(current[0])
+                current = next(known, None)
+                if len(deleted) >= CHUNK_SIZE:
+                    write()
+        finally:
+            write()
+            self.db.execute(f'DROP TABLE temp.{snapshot}')
+        log.debug(counts)
+        return counts
+
+
+    def _item(self, row: tuple) -> dict:
+        name, size, md5, etag, last_modified, tier = row
+        return {
+            "name": name,
+            "content-length": size,
+            "content-md5": md5,
+            "etag": etag,
+            "last-modified": datetime.fromtimestamp(last_modified, timezone.utc) if last_modified is not None else None,
+            "accesstier": tier
+        }
+
+
+    def get(self, container_name: str, blob_path: str) -> dict:
+        """Return the indexed properties of a blob (using listBlobs keys), or None"""
+        row = self.db.execute('SELECT name, size, md5, etag, last_modified, tier FROM blobs WHERE container = ? AND name = ?',
+                              (container_name, blob_path)).fetchone()
+        return self._item(row) if row else None
+
+
+    def exists(self, container_name: str, blob_path: str) -> bool:
+        return self.db.execute('SELECT 1 FROM blobs WHERE container = ? AND name = ?', (container_name, blob_path)).fetchone() is not None
+
+
+    def size(self, container_name: str, blob_path: str) -> int:
+        row = self.db.execute('SELECT size FROM blobs WHERE container = ? AND name = ?', (container_name, blob_path)).fetchone()
+        return row[0] if row else None
+
+
+    def md5(self, container_name: str, blob_path: str) -> bytes:
+        row = self.db.execute('SELECT md5 FROM blobs WHERE container = ? AND name = ?', (container_name, blob_path)).fetchone()
+        return row[0] if row else None
+
+
+    def listBlobs(self, container_name: str, prefix: str = '') -> Generator[dict, None, None]:
+        """Enumerate indexed blobs under prefix, in name order"""
+        for row in self.db.execute(*self._range_query('name, size, md5, etag, last_modified, tier', container_name, prefix)):
+            yield self._item(row)
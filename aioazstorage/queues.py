@@ -6,7 +6,10 @@ from email.utils import formatdate
 from hashlib import sha256, md5
 from hmac import HMAC
 from urllib.parse import urlencode
-from xml.etree import cElementTree
+try:
+    from xml.etree import cElementTree
+except ImportError: # removed in Python 3.9
+    from xml.etree import ElementTree as cElementTree
 try:
     from ujson import dumps
 except ImportError:
@@ -1,10 +1,12 @@
-from aiohttp import ClientSession
-from asyncio import sleep
+from aiohttp import ClientSession, ClientError, ClientResponseError
+from asyncio import sleep, ensure_future, gather, shield, CancelledError, Lock, TimeoutError
 from base64 import b64encode, b64decode
 from datetime import datetime
 from email.utils import formatdate
 from hashlib import sha256, md5
 from hmac import HMAC
+from logging import getLogger
+from re import compile as re_compile
 from urllib.parse import urlencode
 from uuid import uuid1, UUID
 try:
@@ -12,6 +14,11 @@ try:
 except ImportError:
     from json import dumps, loads
 
+log = getLogger(__name__)
+
+BATCH_SIZE = 100 # maximum number of operations in an entity group transaction
+_changeset_status = re_compile(r'HTTP/1\.1 (\d+)')
+_retryable_statuses = (408, 429) # plus any 5xx
 
 _edm_types = {
     datetime: "Edm.DateTime",
@@ -210,8 +217,9 @@ class TableClient:
         return await self.session.delete(uri, headers=headers)
 
 
-    async def batchUpdate(self, table, entities=[]):
-        """Update a set of entities"""
+    async def batchUpdate(self, table, entities=[], operation="insert"):
+        """Update a set of entities (which must share a PartitionKey).
+           `operation` can be "insert", "insertOrReplace" or "insertOrMerge"."""
         canon = "/{}/$batch".format(self.account)
         uri = "https://{}.table.core.windows.net/$batch".format(self.account)
         batch_boundary = '--batch_{}'.format(str(uuid1()))
@@ -224,11 +232,16 @@ class TableClient:
             changeset_boundary,
         ]
         for entity in entities:
+            if operation == "insert":
+                request = 'POST https://{}.table.core.windows.net/{} HTTP/1.1'.format(self.account, table)
+            else:
+                request = "{} https://{}.table.core.windows.net/{}(PartitionKey='{}',RowKey='{}') HTTP/1.1".format(
+                    "MERGE" if operation == "insertOrMerge" else "PUT", self.account, table, entity['PartitionKey'], entity['RowKey'])
             changesets.extend([
                 'Content-Type: application/http',
                 'Content-Transfer-Encoding: binary',
                 '',
-                'POST https://{}.table.core.windows.net/{} HTTP/1.1'.format(self.account, table),
+                request,
                 'Content-Type: application/json',
                 'Accept: application/json;odata=nometadata',
                 'Prefer: return-no-content',
@@ -245,3 +258,153 @@ class TableClient:
             'Accept-Charset': 'UTF-8'
         }
         return await self.session.post(uri, headers=headers, data=payload)
+
+
+class TableWriteBuffer:
+    """Write-behind buffer that coalesces upserts per PartitionKey/RowKey and
+       flushes them as batch changesets once `max_pending` entities are queued
+       or every `flush_interval` seconds, whichever comes first. Entities that
+       fail permanently (or more than `max_retries` times) end up in `failed`."""
+    client = None
+    table = None
+
+    def __init__(self, client, table, merge=False, max_pending=1000, flush_interval=1.0, max_retries=3):
+        """Create a TableWriteBuffer on top of a TableClient. With `merge` set,
+           pending updates to the same entity are merged (and sent as insertOrMerge)
+           instead of the last write replacing earlier ones."""
+
+        self.client = client
+        self.table = table
+        self.merge = merge
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.pending = {}
+        self.retries = {}
+        self.failed = []
+        self.timer = None
+        self.flushing = None
+        self.lock = Lock() # only one flush at a time, so writes to a key reach the service in order
+
+    async def put(self, entity={}):
+        """Queue an entity for writing, coalescing it with any pending update for the same key"""
+        key = (entity['PartitionKey'], entity['RowKey'])
+        if self.merge and key in self.pending:
+            self.pending[key].update(entity)
+        else:
+            self.pending[key] = dict(entity)
+            self.retries.pop(key, None)
+        if self.timer is None and self.flush_interval:
+            self.timer = ensure_future(self._flush_periodically())
+        if len(self.pending) >= self.max_pending:
+            await self.flush()
+
+    async def _flush_periodically(self):
+        while True:
+            await sleep(self.flush_interval)
+            self.flushing = ensure_future(self.flush())
+            try:
+                await shield(self.flushing) # so that close() does not interrupt a flush in progress
+            except CancelledError: # an Exception subclass before Python 3.8
+                raise
+            except Exception as e:
+                log.error(e)
+            self.flushing = None
+
+    async def flush(self):
+        """Write all pending entities, one batch per partition and BATCH_SIZE entities,
+           waiting for any flush already in progress. Entities from batches that failed with a
+           retryable error go back into the buffer (unless a newer write replaced them), others
+           go to `failed`, and the first error is raised."""
+        async with self.lock:
+            pending, self.pending = self.pending, {}
+            partitions = {}
+            for (partition, _), entity in pending.items():
+                partitions.setdefault(partition, []).append(entity)
+            results = await gather(*(self._flush_partition(entities) for entities in partitions.values()), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    def _retryable(self, error):
+        if isinstance(error, ClientResponseError):
+            return error.status in _retryable_statuses or error.status >= 500
+        return isinstance(error, (ClientError, TimeoutError, OSError))
+
+    def _requeue(self, entities, retry=False):
+        """Put entities back into the buffer unless a newer write replaced them,
+           counting a retry against each (and giving up after max_retries) if `retry` is set"""
+        for entity in entities:
+            key = (entity['PartitionKey'], entity['RowKey'])
+            if retry:
+                attempts = self.retries.get(key, 0) + 1
+                if attempts > self.max_retries:
+                    self.retries.pop(key, None)
+                    self.failed.append(entity)
+                    continue
+            if key not in self.pending:
+                self.pending[key] = entity
+            elif self.merge:
+                self.pending[key] = {**entity, **self.pending[key]}
+            else:
+                continue
+            if retry:
+                self.retries[key] = attempts
+
+    async def _flush_partition(self, entities):
+        operation = "insertOrMerge" if self.merge else "insertOrReplace"
+        for offset in range(0, len(entities), BATCH_SIZE):
+            chunk = entities[offset:offset + BATCH_SIZE]
+            try:
+                # batchUpdate annotates entities in place, so hand it copies in case we need to retry
+                res = await self.client.batchUpdate(self.table, [dict(entity) for entity in chunk], operation)
+                try:
+                    body = await res.text()
+                finally:
+                    res.release()
+                # the batch itself returns 202, a failed changeset is only reported in the body
+                statuses = [int(status) for status in _changeset_status.findall(body)]
+                failed = [status for status in statuses if status >= 300]
+                if not res.ok or failed or not statuses:
+                    raise ClientResponseError(res.request_info, res.history, status=failed[0] if failed else res.status, message=body)
+            except CancelledError:
+                self._requeue(entities[offset:])
+                raise
+            except Exception as e:
+                if self._retryable(e):
+                    self._requeue(chunk, retry=True)
+                else:
+                    for entity in chunk:
+                        self.retries.pop((entity['PartitionKey'], entity['RowKey']), None)
+                    self.failed.extend(chunk)
+                self._requeue(entities[offset + BATCH_SIZE:]) # not attempted, so no retry is counted
+                raise
+            for entity in chunk:
+                self.retries.pop((entity['PartitionKey'], entity['RowKey']), None)
+
+    async def close(self):
+        """Stop the flush timer and drain the buffer, retrying failed batches up to
+           max_retries times. Raises the last error if any entity ended up in `failed`."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.flushing is not None:
+            try:
+                await self.flushing
+            except Exception as e:
+                log.error(e)
+            self.flushing = None
+        failures = len(self.failed)
+        error = None
+        while self.pending:
+            try:
+                await self.flush()
+            except CancelledError:
+                raise
+            except Exception as e:
+                log.error(e)
+                error = e
+                if self.pending:
+                    await sleep(self.flush_interval or 1.0)
+        if error is not None and len(self.failed) > failures:
+            raise error
@@ -0,0 +1,80 @@
+from os import environ
+from subprocess import run, PIPE
+from sys import executable, exit
+from time import time
+
+# Cold start benchmark: each measurement runs in a fresh interpreter so that nothing is cached
+
+RUNS=int(environ.get('RUNS',10))
+IMPORT_BUDGET=float(environ.get('IMPORT_BUDGET',0.05)) # seconds allowed for a bare package import
+
+_probe = """
+from time import perf_counter
+from sys import modules
+import logging
+start = perf_counter()
+{statement}
+elapsed = perf_counter() - start
+print(elapsed, 'aiohttp' in modules, len(logging.getLogger().handlers))
+"""
+
+_first_request = """
+from os import environ
+from time import perf_counter
+from asyncio import get_event_loop
+start = perf_counter()
+from aioazstorage import QueueClient
+async def main():
+    q = QueueClient(environ['STORAGE_ACCOUNT'], environ['STORAGE_KEY'])
+    await q.createQueue('aiotest')
+    await q.close()
+get_event_loop().run_until_complete(main())
+print(perf_counter() - start)
+"""
+
+
+def probe(statement: str) -> tuple:
+    """Run statement in a fresh interpreter, returning the best time, whether aiohttp was loaded and root handler count"""
+    results = []
+    for _ in range(RUNS):
+        out = run([executable, '-c', _probe.format(statement=statement)], stdout=PIPE, check=True).stdout.decode('utf-8').split()
+        results.append((float(out[0]), out[1] == 'True', int(out[2])))
+    return min(results)
+
+
+def imports() -> bool:
+    ok = True
+    for label, statement in [
+        ("import aioazstorage", "import aioazstorage"),
+        ("QueueClient", "from aioazstorage import QueueClient"),
+        ("TableClient", "from aioazstorage import TableClient"),
+        ("BlobClient", "from aioazstorage import BlobClient"),
+    ]:
+        elapsed, aiohttp, handlers = probe(statement)
+        print("{:<20} {:8.2f}ms aiohttp={} root_handlers={}".format(label, elapsed * 1000, aiohttp, handlers))
+        if handlers:
+            print("  FAIL: importing configured the root logger")
+            ok = False
+    elapsed, aiohttp, _ = probe("import aioazstorage")
+    if aiohttp:
+        print("FAIL: a bare package import loaded aiohttp")
+        ok = False
+    if elapsed > IMPORT_BUDGET:
+        print("FAIL: a bare package import took more than {}ms".format(IMPORT_BUDGET * 1000))
+        ok = False
+    return ok
+
+
+def first_request() -> None:
+    if 'STORAGE_ACCOUNT' not in environ:
+        print("First request: skipped (STORAGE_ACCOUNT not set)")
+        return
+    start = time()
+    out = run([executable, '-c', _first_request], stdout=PIPE, check=True).stdout.decode('utf-8')
+    print("First request (import + queue creation): {:.2f}ms in-process, {:.2f}ms wall".format(float(out) * 1000, (time() - start) * 1000))
+
+
+if __name__ == '__main__':
+    ok = imports()
+    first_request()
+    exit(0 if ok else 1)
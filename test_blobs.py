@@ -1,16 +1,22 @@
-from aioazstorage import BlobClient
+from aioazstorage import BlobClient, BlobManifest
+from aiohttp import ClientResponseError
+from base64 import b64encode
 from os import environ
 from sys import argv
 from datetime import datetime
 from uuid import uuid1
 from time import time
 from asyncio import set_event_loop_policy, Task, gather
+from logging import basicConfig
 try:
     from uvloop import get_event_loop, EventLoopPolicy
     set_event_loop_policy(EventLoopPolicy())
 except ImportError:
     from asyncio import get_event_loop
 
+basicConfig(format = 'time=%(asctime)s loc=%(funcName)s:%(lineno)d msg="%(message)s"',
+            level  = environ.get('LOGLEVEL','DEBUG'))
+
 STORAGE_ACCOUNT=environ['STORAGE_ACCOUNT']
 STORAGE_KEY=environ['STORAGE_KEY']
 OPERATION_COUNT=int(environ.get('OPERATION_COUNT',10000))
@@ -46,6 +52,60 @@ async def list_blobs() -> None:
     return
 
 
+async def list_blobs_sharded() -> None:
+    c = BlobClient(STORAGE_ACCOUNT, STORAGE_KEY)
+
+    print("Sharded Blob Enumeration", end=" ")
+
+    start = time()
+    i = 0
+    async for blob in c.listBlobsSharded("aiotest", prefixes=[str(d) for d in range(10)], depth=0):
+        i = i + 1
+
+    print("{} entries/s".format(i/(time()-start)))
+    await c.close()
+    return
+
+
+async def manifest() -> None:
+    c = BlobClient(STORAGE_ACCOUNT, STORAGE_KEY)
+    m = BlobManifest('aiotest.manifest')
+
+    print("Manifest Refresh", end=" ")
+    start = time()
+    print(await m.refresh(c, "aiotest"))
+    print("{}s".format(time()-start))
+
+    print("Manifest Lookup", end=" ")
+    start = time()
+    for i in range(OPERATION_COUNT):
+        m.exists("aiotest", str(i))
+    print("{} lookups/s".format(OPERATION_COUNT/(time()-start)))
+    m.close()
+    await c.close()
+    return
+
+
+async def manifest_failure() -> None:
+    c = BlobClient(STORAGE_ACCOUNT, STORAGE_KEY)
+    bad = BlobClient(STORAGE_ACCOUNT, b64encode(b'not the key'))
+    m = BlobManifest()
+
+    print("Manifest Refresh Failure", end=" ")
+    entries = (await m.refresh(c, "aiotest"))["added"]
+    try:
+        await m.refresh(bad, "aiotest")
+        print("FAIL: refresh with a bad key did not raise")
+    except ClientResponseError as e:
+        print(e.status, end=" ")
+    remaining = len(list(m.listBlobs("aiotest")))
+    print("OK" if remaining == entries else "FAIL: {} of {} entries left".format(remaining, entries))
+    m.close()
+    await bad.close()
+    await c.close()
+    return
+
+
 async def blob_write() -> None:
     c = BlobClient(STORAGE_ACCOUNT, STORAGE_KEY)
 
@@ -61,6 +121,36 @@ async def blob_write() -> None:
 
     return
 
+async def blob_copy() -> None:
+    c = BlobClient(STORAGE_ACCOUNT, STORAGE_KEY)
+
+    print("\nBlob Copy:", end=" ")
+    await c.putBlob('aiotest', 'source', bytes('hello world\n', 'utf8'))
+    res = await c.copyBlob('aiotest', 'copy', f'https://{STORAGE_ACCOUNT}.blob.core.windows.net/aiotest/source', wait=True)
+    print(res.status, res.headers.get('x-ms-copy-status'))
+    print("Blob Deletion", end=" ")
+    print((await c.deleteBlob('aiotest', 'copy')).status, (await c.deleteBlob('aiotest', 'source')).status)
+    await c.close()
+    return
+
+
+async def blob_batch() -> None:
+    c = BlobClient(STORAGE_ACCOUNT, STORAGE_KEY)
+
+    print("\nBlob Batch Tiering:", end=" ")
+    start = time()
+    statuses = [item['status'] async for item in c.batchSetBlobTier('aiotest', map(str, range(OPERATION_COUNT)), 'Cool')]
+    print("{} operations/s".format(OPERATION_COUNT/(time()-start)))
+    print(set(statuses))
+
+    print("Blob Batch Deletion:", end=" ")
+    start = time()
+    statuses = [item['status'] async for item in c.batchDeleteBlobs('aiotest', map(str, range(OPERATION_COUNT)))]
+    print("{} operations/s".format(OPERATION_COUNT/(time()-start)))
+    print(set(statuses))
+    await c.close()
+    return
+
 if __name__ == '__main__':
     loop = get_event_loop()
     for test in argv:
@@ -1,4 +1,6 @@
-from aioazstorage import TableClient
+from aioazstorage import TableClient, TableWriteBuffer
+from aiohttp import ClientResponseError
+from base64 import b64encode
 from os import environ
 from datetime import datetime
 from uuid import uuid1
@@ -102,10 +104,46 @@ async def main():
     print(res.headers)
     print(await res.text())
 
+    print("Buffered Upsert:", end=" ")
+    buffer = TableWriteBuffer(t, 'aiotest')
+    start = time()
+    for i in range(OPERATION_COUNT * 10):
+        await buffer.put({
+            "Age": i,
+            "PartitionKey":"mypartitionkey",
+            "RowKey": "Customer%d" % (i % OPERATION_COUNT)
+        })
+    await buffer.close()
+    print("{} operations/s".format(OPERATION_COUNT * 10/(time()-start)))
+
     print()
     await t.close()
 
 
+async def buffer_failure():
+    bad = TableClient(STORAGE_ACCOUNT, b64encode(b'not the key'))
+    buffer = TableWriteBuffer(bad, 'aiotest', flush_interval=0)
+
+    print("Buffered Upsert Failure", end=" ")
+    for i in range(OPERATION_COUNT):
+        await buffer.put({
+            "Age": i,
+            "PartitionKey":"mypartitionkey",
+            "RowKey": "Customer%d" % i
+        })
+    try:
+        await buffer.flush()
+        print("FAIL: flush with a bad key did not raise")
+    except ClientResponseError as e:
+        print(e.status, end=" ")
+    # an authorization failure is not retryable, so nothing is left pending and nothing is lost
+    accounted = len(buffer.pending) + len(buffer.failed)
+    print("OK" if not buffer.pending and accounted == OPERATION_COUNT else "FAIL: {} pending, {} failed".format(len(buffer.pending), len(buffer.failed)))
+    await buffer.close()
+    await bad.close()
+
+
 if __name__ == '__main__':
     loop = get_event_loop()
-    loop.run_until_complete(main())
\ No newline at end of file
+    loop.run_until_complete(main())
+    loop.run_until_complete(buffer_failure())
\ No newline at end of file